@@ -23,7 +23,6 @@ except ImportError:
 
 # configure basic logging and logger for this module
 root = logging.getLogger()
-root.setLevel(logging.DEBUG)
 handler = logging.StreamHandler(sys.stderr)
 formatter = logging.Formatter('%(asctime)s %(levelname)8s [%(name)s] %(message)s')
 handler.setFormatter(formatter)
@@ -46,14 +45,30 @@ args, _ = core_parser.parse_known_args()
 for path in args.proto_files_path:
     sys.path.append(os.path.abspath(os.path.expanduser(path)))
 
+# set the root level too, so that debug calls return immediately rather than creating records to be discarded
 if args.debug:
+    root.setLevel(logging.DEBUG)
     handler.setLevel(logging.DEBUG)
 else:
+    root.setLevel(logging.WARNING)
     handler.setLevel(logging.WARNING)
 
+# the most recently found config_pb2 module, reused for as long as it is still the one imported
+_config_pb2 = None
+
 
 def get_config_pb2(with_fallback: bool = args.use_shipped_fallback):
     """Retrieve prebuilt _pb2 file or attempt to compile it live."""
+    global _config_pb2
+    if _config_pb2 is not None and sys.modules.get('config_pb2') is _config_pb2:
+        return _config_pb2
+
+    _config_pb2 = _find_config_pb2(with_fallback)
+    return _config_pb2
+
+
+def _find_config_pb2(with_fallback: bool):
+    """Import or compile the config_pb2 module from the first viable source."""
     # try to just import a precompiled module if we have been given it in our path
     # (perhaps someone already compiled it for us for whatever reason)
     try:
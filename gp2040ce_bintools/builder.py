@@ -101,7 +101,7 @@ def concatenate_firmware_and_storage_files(firmware_filename: str,      # noqa:
         firmware_binary = bytearray(firmware.read())
 
     # create a sequential binary for .bin and USB uses, or index it for .uf2
-    if usb or combined_filename[-4:] != '.uf2':
+    if usb or not combined_filename.endswith('.uf2'):
         new_binary = combine_firmware_and_config(firmware_binary, board_config_binary, user_config_binary,
                                                  replace_extra=replace_extra)
     else:
@@ -123,7 +123,7 @@ def concatenate_firmware_and_storage_files(firmware_filename: str,      # noqa:
 
     if usb:
         endpoint_out, endpoint_in = get_bootsel_endpoints()
-        write(endpoint_out, endpoint_in, GP2040CE_START_ADDRESS, bytes(new_binary))
+        write(endpoint_out, endpoint_in, GP2040CE_START_ADDRESS, new_binary)
 
 
 def find_version_string_in_binary(binary: bytes) -> str:
@@ -174,7 +174,9 @@ def pad_binary_up_to_address(binary: bytes, position: int, or_truncate: bool = F
         raise FirmwareLengthError(f"provided firmware binary is larger than the start of "
                                   f"storage at {position}!")
 
-    return bytearray(binary) + bytearray(b'\x00' * bytes_to_pad)
+    padded = bytearray(position)
+    padded[:len(binary)] = binary
+    return padded
 
 
 def pad_binary_up_to_board_config(firmware: bytes, or_truncate: bool = False) -> bytearray:
@@ -249,19 +251,18 @@ def write_new_config_to_filename(config: Message, filename: str, inject: bool =
         with open(filename, 'wb') as file:
             file.write(binary)
     else:
-        if filename[-5:] == '.json':
+        if filename.endswith('.json'):
             with open(filename, 'w') as file:
                 file.write(f'{MessageToJson(config)}\n')
         else:
-            binary = storage.serialize_config_with_footer(config)
             with open(filename, 'wb') as file:
-                if filename[-4:] == '.uf2':
+                if filename.endswith('.uf2'):
                     # we must pad to storage start in order for the UF2 write addresses to make sense
                     file.write(storage.convert_binary_to_uf2([
-                        (storage.USER_CONFIG_BINARY_LOCATION, storage.pad_config_to_storage_size(binary)),
+                        (storage.USER_CONFIG_BINARY_LOCATION, storage.serialize_padded_config(config)),
                     ]))
                 else:
-                    file.write(binary)
+                    file.write(storage.serialize_config_with_footer(config))
 
 
 def write_new_config_to_usb(config: Message, endpoint_out: object, endpoint_in: object):
@@ -281,10 +282,10 @@ def write_new_config_to_usb(config: Message, endpoint_out: object, endpoint_in:
     # padding = 256 - (len(serialized) % 256)
     padding = 4096 - (len(serialized) % 4096)
     logger.debug("length: %s with %s bytes of padding", len(serialized), padding)
-    binary = bytearray(b'\x00' * padding) + serialized
+    binary = bytearray(padding + len(serialized))
+    binary[padding:] = serialized
     logger.debug("binary for writing: %s", binary)
-    write(endpoint_out, endpoint_in, storage.USER_CONFIG_BOOTSEL_ADDRESS + (storage.STORAGE_SIZE - len(binary)),
-          bytes(binary))
+    write(endpoint_out, endpoint_in, storage.USER_CONFIG_BOOTSEL_ADDRESS + (storage.STORAGE_SIZE - len(binary)), binary)
 
 
 ############
@@ -338,7 +339,7 @@ def dump_gp2040ce():
     args, _ = parser.parse_known_args()
     content, _, _ = get_gp2040ce_from_usb()
     with open(args.binary_filename, 'wb') as out_file:
-        if args.binary_filename[-4:] == '.uf2':
+        if args.binary_filename.endswith('.uf2'):
             # we must pad to storage start in order for the UF2 write addresses to make sense
             out_file.write(storage.convert_binary_to_uf2([(0, content)]))
         else:
@@ -365,12 +366,12 @@ def summarize_gp2040ce():
 
     gp2040ce_version = find_version_string_in_binary(content)
     try:
-        board_config = storage.get_config(storage.get_board_storage_section(bytes(content)))
+        board_config = storage.get_config(storage.get_board_storage_section(content))
         board_config_version = board_config.boardVersion if board_config.boardVersion else "NOT SPECIFIED"
     except storage.ConfigReadError:
         board_config_version = "NONE"
     try:
-        user_config = storage.get_config(storage.get_user_storage_section(bytes(content)))
+        user_config = storage.get_config(storage.get_user_storage_section(content))
         user_config_version = user_config.boardVersion if user_config.boardVersion else "NOT FOUND"
     except storage.ConfigReadError:
         user_config_version = "NONE"
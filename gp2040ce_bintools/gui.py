@@ -51,7 +51,7 @@ class EditScreen(ModalScreen):
                                             descriptor.FieldDescriptor.TYPE_INT64,
                                             descriptor.FieldDescriptor.TYPE_UINT32,
                                             descriptor.FieldDescriptor.TYPE_UINT64):
-            self.input_field = Input(value=repr(self.field_value), validators=[Number()], id='field-input')
+            self.input_field = Input(value=str(self.field_value), validators=[Number()], id='field-input')
         elif self.field_descriptor.type == descriptor.FieldDescriptor.TYPE_STRING:
             self.input_field = Input(value=self.field_value, id='field-input')
 
@@ -390,7 +390,7 @@ class ConfigEditor(App):
             try:
                 self.endpoint_out, self.endpoint_in = get_bootsel_endpoints()
                 config_binary = read(self.endpoint_out, self.endpoint_in, USER_CONFIG_BOOTSEL_ADDRESS, STORAGE_SIZE)
-                self.config = get_config(bytes(config_binary))
+                self.config = get_config(config_binary)
             except ConfigReadError:
                 if self.create_new:
                     logger.warning("creating new config as the read one was invalid!")
@@ -7,6 +7,7 @@ SPDX-License-Identifier: GPL-3.0-or-later
 """
 import logging
 import struct
+from typing import Union
 
 import usb.core
 
@@ -22,6 +23,13 @@ PICOBOOT_CMD_EXIT_XIP_SUFFIX_STRUCT = '16x'
 PICOBOOT_CMD_READ_SUFFIX_STRUCT = 'LL8x'
 PICOBOOT_CMD_REBOOT_SUFFIX_STRUCT = 'LLL4x'
 
+# compiled once, since the read and write loops pack a command for every chunk
+PICOBOOT_ERASE_CMD = struct.Struct(PICOBOOT_CMD_STRUCT + PICOBOOT_CMD_ERASE_SUFFIX_STRUCT)
+PICOBOOT_EXCLUSIVE_ACCESS_CMD = struct.Struct(PICOBOOT_CMD_STRUCT + PICOBOOT_CMD_EXCLUSIVE_ACCESS_SUFFIX_STRUCT)
+PICOBOOT_EXIT_XIP_CMD = struct.Struct(PICOBOOT_CMD_STRUCT + PICOBOOT_CMD_EXIT_XIP_SUFFIX_STRUCT)
+PICOBOOT_READ_CMD = struct.Struct(PICOBOOT_CMD_STRUCT + PICOBOOT_CMD_READ_SUFFIX_STRUCT)
+PICOBOOT_REBOOT_CMD = struct.Struct(PICOBOOT_CMD_STRUCT + PICOBOOT_CMD_REBOOT_SUFFIX_STRUCT)
+
 PICO_MAGIC = 0x431fd10b
 PICO_SRAM_END = 0x20042000
 # only a partial implementation...
@@ -89,9 +97,8 @@ def exclusive_access(out_end: usb.core.Endpoint, in_end: usb.core.Endpoint, is_e
     command_size = 1
     transfer_len = 0
     exclusive = 1 if is_exclusive else 0
-    payload = struct.pack(PICOBOOT_CMD_STRUCT + PICOBOOT_CMD_EXCLUSIVE_ACCESS_SUFFIX_STRUCT,
-                          PICO_MAGIC, pico_token, PICO_COMMANDS['EXCLUSIVE_ACCESS'], command_size, transfer_len,
-                          exclusive)
+    payload = PICOBOOT_EXCLUSIVE_ACCESS_CMD.pack(PICO_MAGIC, pico_token, PICO_COMMANDS['EXCLUSIVE_ACCESS'],
+                                                 command_size, transfer_len, exclusive)
     logger.debug("EXCLUSIVE_ACCESS: %s", payload)
     out_end.write(payload)
     _ = in_end.read(256)
@@ -111,9 +118,8 @@ def erase(out_end: usb.core.Endpoint, in_end: usb.core.Endpoint, location: int,
     pico_token = 1
     command_size = 8
     transfer_len = 0
-    payload = struct.pack(PICOBOOT_CMD_STRUCT + PICOBOOT_CMD_ERASE_SUFFIX_STRUCT,
-                          PICO_MAGIC, pico_token, PICO_COMMANDS['ERASE'], command_size, transfer_len,
-                          location, size)
+    payload = PICOBOOT_ERASE_CMD.pack(PICO_MAGIC, pico_token, PICO_COMMANDS['ERASE'], command_size, transfer_len,
+                                      location, size)
     logger.debug("ERASE: %s", payload)
     out_end.write(payload)
     _ = in_end.read(256)
@@ -130,8 +136,7 @@ def exit_xip(out_end: usb.core.Endpoint, in_end: usb.core.Endpoint) -> None:
     pico_token = 1
     command_size = 0
     transfer_len = 0
-    payload = struct.pack(PICOBOOT_CMD_STRUCT + PICOBOOT_CMD_EXIT_XIP_SUFFIX_STRUCT,
-                          PICO_MAGIC, pico_token, PICO_COMMANDS['EXIT_XIP'], command_size, transfer_len)
+    payload = PICOBOOT_EXIT_XIP_CMD.pack(PICO_MAGIC, pico_token, PICO_COMMANDS['EXIT_XIP'], command_size, transfer_len)
     logger.debug("EXIT_XIP: %s", payload)
     out_end.write(payload)
     _ = in_end.read(256)
@@ -157,25 +162,26 @@ def read(out_end: usb.core.Endpoint, in_end: usb.core.Endpoint, location: int, s
 
     read_location = location
     read_size = 0
-    content = bytearray()
+    # reads come back in whole chunks, so make room for the last one even if we only want part of it
+    content = bytearray(-(-size // chunk_size) * chunk_size)
     exclusive_access(out_end, in_end, is_exclusive=True)
     while read_size < size:
         exit_xip(out_end, in_end)
         pico_token = 1
-        payload = struct.pack(PICOBOOT_CMD_STRUCT + PICOBOOT_CMD_READ_SUFFIX_STRUCT,
-                              PICO_MAGIC, pico_token, PICO_COMMANDS['READ'] + 128, command_size, chunk_size,
-                              read_location, chunk_size)
+        payload = PICOBOOT_READ_CMD.pack(PICO_MAGIC, pico_token, PICO_COMMANDS['READ'] + 128, command_size, chunk_size,
+                                         read_location, chunk_size)
         logger.debug("READ: %s", payload)
         out_end.write(payload)
         res = in_end.read(chunk_size)
         logger.debug("res: %s", res)
-        content += res
+        content[read_size:read_size + len(res)] = res
         read_size += chunk_size
         read_location += chunk_size
         out_end.write(b'\xc0')
     exclusive_access(out_end, in_end, is_exclusive=False)
-    logger.debug("final content: %s", content[:size])
-    return content[:size]
+    del content[size:]
+    logger.debug("final content: %s", content)
+    return content
 
 
 def reboot(out_end: usb.core.Endpoint) -> None:
@@ -187,13 +193,13 @@ def reboot(out_end: usb.core.Endpoint) -> None:
     boot_start = 0
     boot_end = PICO_SRAM_END
     boot_delay_ms = 500
-    out_end.write(struct.pack(PICOBOOT_CMD_STRUCT + PICOBOOT_CMD_REBOOT_SUFFIX_STRUCT,
-                              PICO_MAGIC, pico_token, PICO_COMMANDS['REBOOT'], command_size, transfer_len,
-                              boot_start, boot_end, boot_delay_ms))
+    out_end.write(PICOBOOT_REBOOT_CMD.pack(PICO_MAGIC, pico_token, PICO_COMMANDS['REBOOT'], command_size, transfer_len,
+                                           boot_start, boot_end, boot_delay_ms))
     # we don't even bother reading here because it may have already rebooted
 
 
-def write(out_end: usb.core.Endpoint, in_end: usb.core.Endpoint, location: int, content: bytes) -> None:
+def write(out_end: usb.core.Endpoint, in_end: usb.core.Endpoint, location: int,
+          content: Union[bytes, bytearray]) -> None:
     """Write content to a RP2040 in BOOTSEL, starting from the specified location.
 
     This also prepares the USB device for writing, so it expects to be able to grab
@@ -220,6 +226,7 @@ def write(out_end: usb.core.Endpoint, in_end: usb.core.Endpoint, location: int,
     exclusive_access(out_end, in_end, is_exclusive=True)
     while write_size < size:
         pico_token = 1
+        # slice the bytes-like content itself: pyusb copies a memoryview element by element
         to_write = content[write_size:(write_size + chunk_size)]
 
         exit_xip(out_end, in_end)
@@ -227,14 +234,13 @@ def write(out_end: usb.core.Endpoint, in_end: usb.core.Endpoint, location: int,
         erase(out_end, in_end, write_location, len(to_write))
 
         logger.debug("writing %s bytes to %s", len(to_write), hex(write_location))
-        payload = struct.pack(PICOBOOT_CMD_STRUCT + PICOBOOT_CMD_READ_SUFFIX_STRUCT,
-                              PICO_MAGIC, pico_token, PICO_COMMANDS['WRITE'], command_size, len(to_write),
-                              write_location, len(to_write))
+        payload = PICOBOOT_READ_CMD.pack(PICO_MAGIC, pico_token, PICO_COMMANDS['WRITE'], command_size, len(to_write),
+                                         write_location, len(to_write))
         logger.debug("WRITE: %s", payload)
         out_end.write(payload)
         logger.debug("actually writing bytes now...")
         logger.debug("payload: %s", to_write)
-        out_end.write(bytes(to_write))
+        out_end.write(to_write)
         res = in_end.read(chunk_size)
         logger.debug("res: %s", res)
         write_size += chunk_size
@@ -4,9 +4,14 @@ SPDX-FileCopyrightText: © 2023 Brian S. Stephan <bss@incorporeal.org>
 SPDX-License-Identifier: GPL-3.0-or-later
 """
 import argparse
-import binascii
 import logging
+import mmap
+import os
+import pathlib
+import stat
 import struct
+import zlib
+from typing import Union
 
 from google.protobuf.json_format import MessageToJson
 from google.protobuf.json_format import Parse as JsonParse
@@ -23,13 +28,22 @@ STORAGE_SIZE = 16384
 USER_CONFIG_BINARY_LOCATION = 0x1FC000
 USER_CONFIG_BOOTSEL_ADDRESS = 0x10000000 + USER_CONFIG_BINARY_LOCATION
 
-FOOTER_SIZE = 12
+# config size, CRC32 of the config, and magic number
+FOOTER_STRUCT = struct.Struct('<LLL')
+FOOTER_SIZE = FOOTER_STRUCT.size
 FOOTER_MAGIC = b'\x65\xe3\xf1\xd2'
+FOOTER_MAGIC_VALUE = int.from_bytes(FOOTER_MAGIC, 'little')
+FOOTER_MAGIC_HEX = f'0x{FOOTER_MAGIC.hex()}'
 
 UF2_FAMILY_ID = 0xE48BFF56
 UF2_MAGIC_FIRST = 0x0A324655
 UF2_MAGIC_SECOND = 0x9E5D5157
 UF2_MAGIC_FINAL = 0x0AB16F30
+UF2_HEADER_STRUCT = struct.Struct('<LLLLLLLL')
+UF2_FOOTER_STRUCT = struct.Struct('<L')
+
+# anything the parsing functions can read from without it first being copied into bytes
+BinaryContent = Union[bytes, bytearray, memoryview, mmap.mmap]
 
 
 #################
@@ -67,57 +81,64 @@ def convert_binary_to_uf2(binaries: list[tuple[int, bytearray]]) -> bytearray:
                         for offset, binary in binaries])
     block_count = 0
 
-    uf2 = bytearray()
+    uf2 = bytearray(total_blocks * 512)
     for start, binary in binaries:
         size = len(binary)
         index = 0
         while index < size:
-            pad_count = 476 - len(binary[index:index+256])
-            uf2 += struct.pack('<LLLLLLLL',
-                               UF2_MAGIC_FIRST,                                 # first magic number
-                               UF2_MAGIC_SECOND,                                # second magic number
-                               0x00002000,                                      # familyID present
-                               0x10000000 + start + index,                      # address to write to
-                               256,                                             # bytes to write in this block
-                               block_count,                                     # sequential block number
-                               total_blocks,                                    # total number of blocks
-                               UF2_FAMILY_ID)                                   # family ID
-            uf2 += binary[index:index+256] + bytearray(b'\x00' * pad_count)     # content
-            uf2 += struct.pack('<L', UF2_MAGIC_FINAL)                           # final magic number
+            offset = block_count * 512
+            UF2_HEADER_STRUCT.pack_into(uf2, offset,
+                                        UF2_MAGIC_FIRST,                        # first magic number
+                                        UF2_MAGIC_SECOND,                       # second magic number
+                                        0x00002000,                             # familyID present
+                                        0x10000000 + start + index,             # address to write to
+                                        256,                                    # bytes to write in this block
+                                        block_count,                            # sequential block number
+                                        total_blocks,                           # total number of blocks
+                                        UF2_FAMILY_ID)                          # family ID
+            content = binary[index:index+256]                                   # content, rest is already zeroed
+            uf2[offset+32:offset+32+len(content)] = content
+            UF2_FOOTER_STRUCT.pack_into(uf2, offset+508, UF2_MAGIC_FINAL)       # final magic number
             index += 256
             block_count += 1
     return uf2
 
 
-def convert_uf2_to_binary(uf2: bytearray) -> bytearray:
+def convert_uf2_to_binary(uf2: BinaryContent) -> bytearray:
     """Convert a Microsoft's UF2 payload to a raw binary.
 
     https://github.com/microsoft/uf2/tree/master#overview
 
     Args:
-        uf2: bytearray content to convert from a UF2 payload
+        uf2: content to convert from a UF2 payload
     Returns:
         the content in sequential binary format
     """
     if len(uf2) % 512 != 0:
         raise ValueError(f"provided binary is length {len(uf2)}, which isn't fully divisible by 512!")
 
+    if not uf2:
+        raise ValueError("provided binary is empty, so it has no UF2 blocks!")
+
     binary = bytearray()
     old_uf2_addr = None
+    uf2_view = memoryview(uf2)
+
+    # every block carries the total block count, so the first block's is enough to check the length against
+    block_count = UF2_HEADER_STRUCT.unpack_from(uf2_view, 0)[6]
+    if block_count != len(uf2) // 512:
+        raise ValueError(f"inconsistent block count in reading UF2, got {block_count}, expected {len(uf2) // 512}!")
 
     for index in range(0, len(uf2), 512):
-        chunk = uf2[index:index+512]
-        _, _, _, uf2_addr, bytes_, block_num, block_count, _ = struct.unpack('<LLLLLLLL', chunk[0:32])
-        content = chunk[32:508]
+        _, _, _, uf2_addr, bytes_, block_num, _, _ = UF2_HEADER_STRUCT.unpack_from(uf2_view, index)
+        content = uf2_view[index+32:index+508]
         if block_num != index // 512:
             raise ValueError(f"inconsistent block number in reading UF2, got {block_num}, expected {index // 512}!")
-        if block_count != len(uf2) // 512:
-            raise ValueError(f"inconsistent block count in reading UF2, got {block_count}, expected {len(uf2) // 512}!")
 
         if old_uf2_addr and (uf2_addr >= old_uf2_addr + bytes_):
             # the new binary content is not immediately after what we wrote, it's further ahead, so pad
             # the difference
-            binary += bytearray(b'\x00' * (uf2_addr - (old_uf2_addr + bytes_)))
+            binary += bytearray(uf2_addr - (old_uf2_addr + bytes_))
         elif old_uf2_addr and (uf2_addr < old_uf2_addr + bytes_):
             # this is seeking backwards which we don't see yet
             raise NotImplementedError("going backwards in binary files is not yet supported")
@@ -125,25 +146,22 @@ def convert_uf2_to_binary(uf2: bytearray) -> bytearray:
         binary += content[0:bytes_]
         old_uf2_addr = uf2_addr
 
-    # when this is all done we should have counted the expected number of blocks
-    if block_count != block_num + 1:
-        raise ValueError(f"not all expected blocks ({block_count}) were found, only got {block_num + 1}!")
     return binary
 
 
-def get_config(content: bytes) -> Message:
+def get_config(content: BinaryContent, verify_crc: bool = True) -> Message:
     """Read the config from a GP2040-CE storage section.
 
     Args:
         content: bytes from a GP2040-CE board's storage section
+        verify_crc: if false, trust the footer and skip checking the config's CRC checksum
     Returns:
         the parsed configuration
     """
-    size, _, _ = get_config_footer(content)
+    size, _, _ = get_config_footer(content, verify_crc=verify_crc)
 
-    config_pb2 = get_config_pb2()
-    config = config_pb2.Config()
-    config.ParseFromString(content[-(size + FOOTER_SIZE):-FOOTER_SIZE])
+    config = get_new_config()
+    config.ParseFromString(memoryview(content)[-(size + FOOTER_SIZE):-FOOTER_SIZE])
     logger.debug("parsed: %s", config)
     return config
 
@@ -156,22 +174,23 @@ def get_config_from_json(content: str) -> Message:
     Returns:
         the parsed configuration
     """
-    config_pb2 = get_config_pb2()
-    config = config_pb2.Config()
+    config = get_new_config()
     JsonParse(content, config)
     logger.debug("parsed: %s", config)
     return config
 
 
-def get_config_footer(content: bytes) -> tuple[int, int, str]:
+def get_config_footer(content: BinaryContent, verify_crc: bool = True) -> tuple[int, int, str]:
     """Confirm and retrieve the config footer from a series of bytes of GP2040-CE storage.
 
     Args:
         content: bytes from a GP2040-CE board's storage section
+        verify_crc: if false, trust the footer and skip checking the config's CRC checksum
     Returns:
         the discovered config size, config CRC checksum, and magic from the config footer
     Raises:
         ConfigLengthError, ConfigMagicError: if the provided bytes are not a config footer
+        ConfigCrcError: if verifying the CRC checksum and it doesn't match the config
     """
     # last 12 bytes are the footer
     logger.debug("length of content to look for footer in: %s", len(content))
@@ -179,14 +198,11 @@ def get_config_footer(content: bytes) -> tuple[int, int, str]:
     if len(content) < FOOTER_SIZE:
         raise ConfigLengthError(f"provided content ({len(content)} bytes) is not large enough to have a config footer!")
 
-    footer = content[-FOOTER_SIZE:]
-    logger.debug("suspected footer magic: %s", footer[-4:])
-    if footer[-4:] != FOOTER_MAGIC:
+    config_size, config_crc, magic = FOOTER_STRUCT.unpack_from(content, len(content) - FOOTER_SIZE)
+    if magic != FOOTER_MAGIC_VALUE:
         raise ConfigMagicError("content's magic is not as expected!")
 
-    config_size = int.from_bytes(reversed(footer[:4]), 'big')
-    config_crc = int.from_bytes(reversed(footer[4:8]), 'big')
-    config_magic = f'0x{footer[8:12].hex()}'
+    config_magic = FOOTER_MAGIC_HEX
 
     # more sanity checks
     logger.debug("length of content + footer: %s", len(content))
@@ -196,14 +212,17 @@ def get_config_footer(content: bytes) -> tuple[int, int, str]:
 
     logger.debug("config size according to footer: %s", config_size)
 
-    content_config = content[-(config_size + 12):-12]
-    content_crc = binascii.crc32(content_config)
-    logger.debug("content used to calculate CRC: %s", content_config)
-    logger.debug("calculated config CRC: %s", content_crc)
-    logger.debug("expected config CRC: %s", config_crc)
-    if config_crc != content_crc:
-        raise ConfigCrcError(f"provided content CRC checksum {content_crc} does not match footer's expected CRC "
-                             f"checksum {config_crc}!")
+    if verify_crc:
+        content_config = memoryview(content)[-(config_size + 12):-12]
+        content_crc = zlib.crc32(content_config)
+        if logger.isEnabledFor(logging.DEBUG):
+            # copied only for the log, since a view would print as just its address
+            logger.debug("content used to calculate CRC: %s", bytes(content_config))
+        logger.debug("calculated config CRC: %s", content_crc)
+        logger.debug("expected config CRC: %s", config_crc)
+        if config_crc != content_crc:
+            raise ConfigCrcError(f"provided content CRC checksum {content_crc} does not match footer's expected CRC "
+                                 f"checksum {config_crc}!")
 
     logger.debug("detected footer (size:%s, crc:%s, magic:%s", config_size, config_crc, config_magic)
     return config_size, config_crc, config_magic
@@ -212,6 +231,8 @@ def get_config_footer(content: bytes) -> tuple[int, int, str]:
 def get_binary_from_file(filename: str) -> bytes:
     """Read the specified file (.bin or .uf2) and get back its raw binary contents.
 
+    UF2 files are recognized by the magic numbers at the start of their content, not by their suffix.
+
     Args:
         filename: the filename of the file to open and read
     Returns:
@@ -219,17 +240,16 @@ def get_binary_from_file(filename: str) -> bytes:
     Raises:
         FileNotFoundError: if the file was not found
     """
-    with open(filename, 'rb') as dump:
-        if filename[-4:] == '.uf2':
-            content = bytes(convert_uf2_to_binary(bytearray(dump.read())))
-        else:
-            content = dump.read()
+    content = pathlib.Path(filename).read_bytes()
+    if is_uf2(content):
+        logger.debug("%s has UF2 magic, converting it to a raw binary", filename)
+        content = bytes(convert_uf2_to_binary(content))
 
     return content
 
 
 def get_config_from_file(filename: str, whole_board: bool = False, allow_no_file: bool = False,
-                         board_config: bool = False) -> Message:
+                         board_config: bool = False, verify_crc: bool = True) -> Message:
     """Read the specified file (memory dump or whole board dump) and get back its config section.
 
     Args:
@@ -237,34 +257,34 @@ def get_config_from_file(filename: str, whole_board: bool = False, allow_no_file
         whole_board: optional, if true, attempt to find the storage section from its normal location on a board
         allow_no_file: if true, attempting to open a nonexistent file returns an empty config, else it errors
         board_config: if true, the board config is provided instead of the user config
+        verify_crc: if false, trust the footer and skip checking the config's CRC checksum
     Returns:
         the parsed configuration
     """
     try:
-        if filename[-5:] == '.json':
+        if filename.endswith('.json'):
             with open(filename) as file_:
                 return get_config_from_json(file_.read())
-        else:
-            content = get_binary_from_file(filename)
-            if whole_board:
-                if board_config:
-                    return get_config(get_board_storage_section(content))
-                else:
-                    return get_config(get_user_storage_section(content))
+        elif whole_board:
+            if board_config:
+                address = BOARD_CONFIG_BINARY_LOCATION
             else:
-                return get_config(content)
+                address = USER_CONFIG_BINARY_LOCATION
+            return get_config(get_storage_section_from_file(filename, address), verify_crc=verify_crc)
+        else:
+            return get_config(get_binary_from_file(filename), verify_crc=verify_crc)
     except FileNotFoundError:
         if not allow_no_file:
             raise
-        config_pb2 = get_config_pb2()
-        return config_pb2.Config()
+        return get_new_config()
 
 
-def get_config_from_usb(address: int) -> tuple[Message, object, object]:
+def get_config_from_usb(address: int, verify_crc: bool = True) -> tuple[Message, object, object]:
     """Read a config section from a USB device and provide the protobuf Message.
 
     Args:
         address: location of the flash to start reading from
+        verify_crc: if false, trust the footer and skip checking the config's CRC checksum
     Returns:
         the parsed configuration, along with the USB out and in endpoints for reference
     """
@@ -273,28 +293,32 @@ def get_config_from_usb(address: int) -> tuple[Message, object, object]:
     logger.debug("reading DEVICE ID %s:%s, bus %s, address %s", hex(endpoint_out.device.idVendor),
                  hex(endpoint_out.device.idProduct), endpoint_out.device.bus, endpoint_out.device.address)
     storage = read(endpoint_out, endpoint_in, address, STORAGE_SIZE)
-    return get_config(bytes(storage)), endpoint_out, endpoint_in
+    return get_config(storage, verify_crc=verify_crc), endpoint_out, endpoint_in
 
 
-def get_board_config_from_usb() -> tuple[Message, object, object]:
+def get_board_config_from_usb(verify_crc: bool = True) -> tuple[Message, object, object]:
     """Read the board configuration from the detected USB device.
 
+    Args:
+        verify_crc: if false, trust the footer and skip checking the config's CRC checksum
     Returns:
         the parsed configuration, along with the USB out and in endpoints for reference
     """
-    return get_config_from_usb(BOARD_CONFIG_BOOTSEL_ADDRESS)
+    return get_config_from_usb(BOARD_CONFIG_BOOTSEL_ADDRESS, verify_crc=verify_crc)
 
 
-def get_user_config_from_usb() -> tuple[Message, object, object]:
+def get_user_config_from_usb(verify_crc: bool = True) -> tuple[Message, object, object]:
     """Read the user configuration from the detected USB device.
 
+    Args:
+        verify_crc: if false, trust the footer and skip checking the config's CRC checksum
     Returns:
         the parsed configuration, along with the USB out and in endpoints for reference
     """
-    return get_config_from_usb(USER_CONFIG_BOOTSEL_ADDRESS)
+    return get_config_from_usb(USER_CONFIG_BOOTSEL_ADDRESS, verify_crc=verify_crc)
 
 
-def get_storage_section(content: bytes, address: int) -> bytes:
+def get_storage_section(content: BinaryContent, address: int) -> bytes:
     """Pull out what should be the GP2040-CE storage section from a whole board dump.
 
     Args:
@@ -311,10 +335,47 @@ def get_storage_section(content: bytes, address: int) -> bytes:
         raise ConfigLengthError("provided content is not large enough to have a storage section!")
 
     logger.debug("returning bytes from %s to %s", hex(address), hex(address + STORAGE_SIZE))
-    return content[address:(address + STORAGE_SIZE)]
+    # copy through a view, which is released right away rather than pinning the content (e.g. a mmap) behind it
+    with memoryview(content)[address:(address + STORAGE_SIZE)] as section:
+        return bytes(section)
+
+
+def get_storage_section_from_file(filename: str, address: int) -> bytes:
+    """Read just the GP2040-CE storage section out of a whole board dump file.
+
+    Raw binary dump files are memory mapped, so only the storage section is read from disk rather than the whole
+    (potentially 16 MB) dump. UF2 files are read and converted in full, since their blocks must be reassembled first,
+    as is anything that can't be mapped (e.g. a pipe).
+
+    Args:
+        filename: the filename of the whole board dump to open and read
+        address: location of the storage section in the binary
+    Returns:
+        a copy of the presumed storage section from the file
+    Raises:
+        FileNotFoundError: if the file was not found
+        ConfigLengthError: if the file doesn't appear to have a storage section
+    """
+    with open(filename, 'rb') as dump:
+        dump_stat = os.fstat(dump.fileno())
+        if not stat.S_ISREG(dump_stat.st_mode):
+            # pipes and other special files report no size and can't be mapped, so just read them
+            content = dump.read()
+        elif not dump_stat.st_size:
+            # an empty file can't be mapped either, but has no storage section anyway
+            raise ConfigLengthError("provided file is empty, so it has no storage section!")
+        else:
+            with mmap.mmap(dump.fileno(), 0, access=mmap.ACCESS_READ) as board:
+                if not is_uf2(board):
+                    return get_storage_section(board, address)
+                content = board[:]
 
+    if is_uf2(content):
+        return get_storage_section(convert_uf2_to_binary(content), address)
+    return get_storage_section(content, address)
 
-def get_board_storage_section(content: bytes) -> bytes:
+
+def get_board_storage_section(content: BinaryContent) -> bytes:
     """Get the board storage area from what should be a whole board GP2040-CE dump.
 
     Args:
@@ -327,7 +388,7 @@ def get_board_storage_section(content: bytes) -> bytes:
     return get_storage_section(content, BOARD_CONFIG_BINARY_LOCATION)
 
 
-def get_user_storage_section(content: bytes) -> bytes:
+def get_user_storage_section(content: BinaryContent) -> bytes:
     """Get the user storage area from what should be a whole board GP2040-CE dump.
 
     Args:
@@ -340,6 +401,17 @@ def get_user_storage_section(content: bytes) -> bytes:
     return get_storage_section(content, USER_CONFIG_BINARY_LOCATION)
 
 
+def is_uf2(content: BinaryContent) -> bool:
+    """Check if the provided content looks like a UF2 payload, based on the magic numbers it starts with.
+
+    Args:
+        content: bytes to check
+    Returns:
+        True if the content starts with the UF2 first and second magic numbers
+    """
+    return len(content) >= 8 and struct.unpack_from('<LL', content) == (UF2_MAGIC_FIRST, UF2_MAGIC_SECOND)
+
+
 def get_new_config() -> Message:
     """Wrap the creation of a new Config message.
 
@@ -360,23 +432,60 @@ def pad_config_to_storage_size(config: bytes) -> bytearray:
     Raises:
         FirmwareLengthError: if the  is larger than the storage location
     """
-    bytes_to_pad = STORAGE_SIZE - len(config)
-    logger.debug("config is length %s, padding %s bytes", len(config), bytes_to_pad)
+    bytes_to_pad = _get_storage_padding(len(config))
+    storage = bytearray(STORAGE_SIZE)
+    storage[bytes_to_pad:] = config
+    return storage
+
+
+def _get_storage_padding(config_size: int) -> int:
+    """Work out how much zero padding precedes a config (with footer) in the storage section.
+
+    Args:
+        config_size: length of the config section binary, including its footer
+    Returns:
+        the number of padding bytes needed to fill out the storage section
+    Raises:
+        ConfigLengthError: if the config is larger than the storage section
+    """
+    bytes_to_pad = STORAGE_SIZE - config_size
+    logger.debug("config is length %s, padding %s bytes", config_size, bytes_to_pad)
     if bytes_to_pad < 0:
         raise ConfigLengthError(f"provided config binary is larger than the allowed storage of "
                                 f"storage at {STORAGE_SIZE} bytes!")
-
-    return bytearray(b'\x00' * bytes_to_pad) + bytearray(config)
+    return bytes_to_pad
 
 
 def serialize_config_with_footer(config: Message) -> bytearray:
     """Given a config, generate the config footer as expected by GP2040-CE."""
     config_bytes = config.SerializeToString()
-    config_size = bytes(reversed(config.ByteSize().to_bytes(4, 'big')))
-    config_crc = bytes(reversed(binascii.crc32(config_bytes).to_bytes(4, 'big')))
-    config_magic = FOOTER_MAGIC
+    binary = bytearray(len(config_bytes) + FOOTER_SIZE)
+    binary[:len(config_bytes)] = config_bytes
+    FOOTER_STRUCT.pack_into(binary, len(config_bytes), len(config_bytes), zlib.crc32(config_bytes), FOOTER_MAGIC_VALUE)
+    return binary
+
+
+def serialize_padded_config(config: Message) -> bytearray:
+    """Given a config, generate a full storage section with the config and its footer at the end.
+
+    This is equivalent to pad_config_to_storage_size(serialize_config_with_footer(config)), but
+    builds the section in one buffer rather than copying through the intermediate binaries.
+
+    Args:
+        config: the config to serialize
+    Returns:
+        the config and footer, preceded by zero padding, as a STORAGE_SIZE bytearray
+    Raises:
+        ConfigLengthError: if the serialized config and footer are larger than the storage section
+    """
+    config_bytes = config.SerializeToString()
+    config_start = _get_storage_padding(len(config_bytes) + FOOTER_SIZE)
 
-    return config_bytes + config_size + config_crc + config_magic
+    storage = bytearray(STORAGE_SIZE)
+    storage[config_start:-FOOTER_SIZE] = config_bytes
+    FOOTER_STRUCT.pack_into(storage, STORAGE_SIZE - FOOTER_SIZE, len(config_bytes), zlib.crc32(config_bytes),
+                            FOOTER_MAGIC_VALUE)
+    return storage
 
 
 ############
@@ -399,15 +508,14 @@ def dump_config():
         config, _, _ = get_board_config_from_usb()
     else:
         config, _, _ = get_user_config_from_usb()
-    binary_config = serialize_config_with_footer(config)
     with open(args.filename, 'wb') as out_file:
-        if args.filename[-4:] == '.uf2':
+        if args.filename.endswith('.uf2'):
             # we must pad to storage start in order for the UF2 write addresses to make sense
             out_file.write(convert_binary_to_uf2([
-                (USER_CONFIG_BINARY_LOCATION, pad_config_to_storage_size(binary_config)),
+                (USER_CONFIG_BINARY_LOCATION, serialize_padded_config(config)),
             ]))
         else:
-            out_file.write(binary_config)
+            out_file.write(serialize_config_with_footer(config))
 
 
 def visualize():
@@ -3,71 +3,65 @@
 SPDX-FileCopyrightText: © 2023 Brian S. Stephan <bss@incorporeal.org>
 SPDX-License-Identifier: GPL-3.0-or-later
 """
+import functools
 import os
+import pathlib
+import sys
 
 import pytest
 
 HERE = os.path.dirname(os.path.abspath(__file__))
+PB2_PATH = os.path.join(HERE, 'test-files', 'pb2-files')
 
 
-@pytest.fixture
+@functools.cache
+def _read_test_file(filename: str) -> bytes:
+    """Read in one of the test files, once per session no matter how many fixtures need it."""
+    return pathlib.Path(HERE, 'test-files', filename).read_bytes()
+
+
+@pytest.fixture(scope='session', autouse=True)
+def with_pb2s():
+    """Put the precompiled pb2 files on the path once for the whole session."""
+    sys.path.append(PB2_PATH)
+    yield
+    sys.path.remove(PB2_PATH)
+
+
+@pytest.fixture(scope='session')
 def config_binary():
     """Read in a test GP2040-CE configuration, Protobuf serialized binary form with footer."""
-    filename = os.path.join(HERE, 'test-files', 'test-config.bin')
-    with open(filename, 'rb') as file:
-        content = file.read()
-
-    yield content
+    yield _read_test_file('test-config.bin')
 
 
-@pytest.fixture
+@pytest.fixture(scope='session')
 def config_json():
     """Read in a test GP2040-CE configuration, Protobuf serialized binary form with footer."""
-    filename = os.path.join(HERE, 'test-files', 'test-config.json')
-    with open(filename, 'r') as file:
-        content = file.read()
+    yield _read_test_file('test-config.json').decode()
 
-    yield content
 
-
-@pytest.fixture
+@pytest.fixture(scope='session')
 def firmware_binary():
     """Read in a test GP2040-CE firmware binary file."""
-    filename = os.path.join(HERE, 'test-files', 'test-firmware.bin')
-    with open(filename, 'rb') as file:
-        content = file.read()
-
-    yield content
+    yield _read_test_file('test-firmware.bin')
 
 
-@pytest.fixture
+@pytest.fixture(scope='session')
 def storage_dump():
     """Read in a test storage dump file (101FC000-10200000) of a GP2040-CE board."""
-    filename = os.path.join(HERE, 'test-files', 'test-storage-area.bin')
-    with open(filename, 'rb') as file:
-        content = file.read()
-
-    yield content
+    yield _read_test_file('test-storage-area.bin')
 
 
-@pytest.fixture
+@pytest.fixture(scope='session')
 def whole_board_dump():
     """Read in a test whole board dump file of a GP2040-CE board.
 
     NOTE: this is from a 16 MB flash because I used an ABB for this test.
     """
-    filename = os.path.join(HERE, 'test-files', 'test-whole-board.bin')
-    with open(filename, 'rb') as file:
-        content = file.read()
+    yield _read_test_file('test-whole-board.bin')
 
-    yield content
 
-
-@pytest.fixture
+@pytest.fixture(scope='session')
 def whole_board_with_board_config_dump():
     """Read in a test whole board dump file of a GP2040-CE board plus board config."""
-    filename = os.path.join(HERE, 'test-files', 'test-whole-board-with-board-config.bin')
-    with open(filename, 'rb') as file:
-        content = file.read()
-
-    yield content
+    yield _read_test_file('test-whole-board-with-board-config.bin')
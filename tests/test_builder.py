@@ -6,42 +6,28 @@ SPDX-License-Identifier: GPL-3.0-or-later
 import logging
 import math
 import os
-import sys
 import unittest.mock as mock
+from types import SimpleNamespace
 
 import pytest
-from decorator import decorator
 
 import gp2040ce_bintools.builder as builder
 from gp2040ce_bintools import get_config_pb2
 from gp2040ce_bintools.storage import (STORAGE_SIZE, get_board_storage_section, get_config, get_config_footer,
-                                       get_config_from_json, get_user_storage_section, serialize_config_with_footer)
+                                       get_config_from_json, get_user_storage_section)
 
 HERE = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE_FILE = os.path.join(HERE, 'test-files', 'test-firmware.bin')
+CONFIG_FILE = os.path.join(HERE, 'test-files', 'test-config.bin')
+CONFIG_JSON_FILE = os.path.join(HERE, 'test-files', 'test-config.json')
 
 logger = logging.getLogger(__name__)
 
 
-@decorator
-def with_pb2s(test, *args, **kwargs):
-    """Wrap a test with precompiled pb2 files on the path."""
-    proto_path = os.path.join(HERE, 'test-files', 'pb2-files')
-    sys.path.append(proto_path)
-
-    test(*args, **kwargs)
-
-    sys.path.pop()
-    del sys.modules['config_pb2']
-    del sys.modules['enums_pb2']
-    del sys.modules['nanopb_pb2']
-
-
 def test_concatenate_to_file(tmp_path):
     """Test that we write a file with firmware + binary user config as expected."""
     tmp_file = os.path.join(tmp_path, 'concat.bin')
-    firmware_file = os.path.join(HERE, 'test-files', 'test-firmware.bin')
-    config_file = os.path.join(HERE, 'test-files', 'test-config.bin')
-    builder.concatenate_firmware_and_storage_files(firmware_file, binary_user_config_filename=config_file,
+    builder.concatenate_firmware_and_storage_files(FIRMWARE_FILE, binary_user_config_filename=CONFIG_FILE,
                                                    combined_filename=tmp_file)
     with open(tmp_file, 'rb') as file:
         content = file.read()
@@ -51,9 +37,7 @@ def test_concatenate_to_file(tmp_path):
 def test_concatenate_board_config_to_file(tmp_path):
     """Test that we write a file with firmware + binary board config as expected."""
     tmp_file = os.path.join(tmp_path, 'concat.bin')
-    firmware_file = os.path.join(HERE, 'test-files', 'test-firmware.bin')
-    config_file = os.path.join(HERE, 'test-files', 'test-config.bin')
-    builder.concatenate_firmware_and_storage_files(firmware_file, binary_board_config_filename=config_file,
+    builder.concatenate_firmware_and_storage_files(FIRMWARE_FILE, binary_board_config_filename=CONFIG_FILE,
                                                    combined_filename=tmp_file)
     with open(tmp_file, 'rb') as file:
         content = file.read()
@@ -63,10 +47,8 @@ def test_concatenate_board_config_to_file(tmp_path):
 def test_concatenate_both_configs_to_file(tmp_path):
     """Test that we write a file with firmware + binary board + binary user config as expected."""
     tmp_file = os.path.join(tmp_path, 'concat.bin')
-    firmware_file = os.path.join(HERE, 'test-files', 'test-firmware.bin')
-    config_file = os.path.join(HERE, 'test-files', 'test-config.bin')
-    builder.concatenate_firmware_and_storage_files(firmware_file, binary_board_config_filename=config_file,
-                                                   binary_user_config_filename=config_file, combined_filename=tmp_file)
+    builder.concatenate_firmware_and_storage_files(FIRMWARE_FILE, binary_board_config_filename=CONFIG_FILE,
+                                                   binary_user_config_filename=CONFIG_FILE, combined_filename=tmp_file)
     with open(tmp_file, 'rb') as file:
         content = file.read()
     assert len(content) == 2 * 1024 * 1024
@@ -78,13 +60,10 @@ def test_concatenate_both_configs_to_file(tmp_path):
     assert footer_size == 3309
 
 
-@with_pb2s
 def test_concatenate_user_json_to_file(tmp_path):
     """Test that we write a file with firmware + JSON user config as expected."""
     tmp_file = os.path.join(tmp_path, 'concat.bin')
-    firmware_file = os.path.join(HERE, 'test-files', 'test-firmware.bin')
-    config_file = os.path.join(HERE, 'test-files', 'test-config.json')
-    builder.concatenate_firmware_and_storage_files(firmware_file, json_user_config_filename=config_file,
+    builder.concatenate_firmware_and_storage_files(FIRMWARE_FILE, json_user_config_filename=CONFIG_JSON_FILE,
                                                    combined_filename=tmp_file)
     with open(tmp_file, 'rb') as file:
         content = file.read()
@@ -94,19 +73,16 @@ def test_concatenate_user_json_to_file(tmp_path):
 def test_concatenate_to_file_incomplete_args_is_error(tmp_path):
     """Test that we bail properly if we weren't given all the necessary arguments to make a binary."""
     tmp_file = os.path.join(tmp_path, 'concat.bin')
-    firmware_file = os.path.join(HERE, 'test-files', 'test-firmware.bin')
     with pytest.raises(ValueError):
-        builder.concatenate_firmware_and_storage_files(firmware_file, combined_filename=tmp_file)
+        builder.concatenate_firmware_and_storage_files(FIRMWARE_FILE, combined_filename=tmp_file)
 
 
 def test_concatenate_to_usb(tmp_path):
     """Test that we write a file as expected."""
-    firmware_file = os.path.join(HERE, 'test-files', 'test-firmware.bin')
-    config_file = os.path.join(HERE, 'test-files', 'test-config.bin')
-    end_out, end_in = mock.MagicMock(), mock.MagicMock()
+    end_out, end_in = SimpleNamespace(), SimpleNamespace()
     with mock.patch('gp2040ce_bintools.builder.get_bootsel_endpoints', return_value=(end_out, end_in)):
         with mock.patch('gp2040ce_bintools.builder.write') as mock_write:
-            builder.concatenate_firmware_and_storage_files(firmware_file, binary_user_config_filename=config_file,
+            builder.concatenate_firmware_and_storage_files(FIRMWARE_FILE, binary_user_config_filename=CONFIG_FILE,
                                                            usb=True)
 
     assert mock_write.call_args.args[2] == 0x10000000
@@ -116,10 +92,8 @@ def test_concatenate_to_usb(tmp_path):
 def test_concatenate_to_uf2(tmp_path, firmware_binary, config_binary):
     """Test that we write a UF2 file as expected."""
     tmp_file = os.path.join(tmp_path, 'concat.uf2')
-    firmware_file = os.path.join(HERE, 'test-files', 'test-firmware.bin')
-    config_file = os.path.join(HERE, 'test-files', 'test-config.bin')
-    builder.concatenate_firmware_and_storage_files(firmware_file, binary_board_config_filename=config_file,
-                                                   binary_user_config_filename=config_file,
+    builder.concatenate_firmware_and_storage_files(FIRMWARE_FILE, binary_board_config_filename=CONFIG_FILE,
+                                                   binary_user_config_filename=CONFIG_FILE,
                                                    combined_filename=tmp_file)
     with open(tmp_file, 'rb') as file:
         content = file.read()
@@ -131,9 +105,7 @@ def test_concatenate_to_uf2(tmp_path, firmware_binary, config_binary):
 def test_concatenate_to_uf2_board_only(tmp_path, firmware_binary, config_binary):
     """Test that we write a UF2 file as expected."""
     tmp_file = os.path.join(tmp_path, 'concat.uf2')
-    firmware_file = os.path.join(HERE, 'test-files', 'test-firmware.bin')
-    config_file = os.path.join(HERE, 'test-files', 'test-config.bin')
-    builder.concatenate_firmware_and_storage_files(firmware_file, binary_board_config_filename=config_file,
+    builder.concatenate_firmware_and_storage_files(FIRMWARE_FILE, binary_board_config_filename=CONFIG_FILE,
                                                    combined_filename=tmp_file)
     with open(tmp_file, 'rb') as file:
         content = file.read()
@@ -145,14 +117,12 @@ def test_concatenate_to_uf2_board_only(tmp_path, firmware_binary, config_binary)
 def test_concatenate_with_backup(tmp_path, firmware_binary, config_binary):
     """Test that we write a UF2 file as expected."""
     tmp_file = os.path.join(tmp_path, 'concat.uf2')
-    firmware_file = os.path.join(HERE, 'test-files', 'test-firmware.bin')
-    config_file = os.path.join(HERE, 'test-files', 'test-config.bin')
     # create the file we are going to try to overwrite and want backed up
-    builder.concatenate_firmware_and_storage_files(firmware_file, binary_board_config_filename=config_file,
+    builder.concatenate_firmware_and_storage_files(FIRMWARE_FILE, binary_board_config_filename=CONFIG_FILE,
                                                    combined_filename=tmp_file)
     # second file, expecting an overwrite of the target with a backup made
-    builder.concatenate_firmware_and_storage_files(firmware_file, binary_board_config_filename=config_file,
-                                                   binary_user_config_filename=config_file,
+    builder.concatenate_firmware_and_storage_files(FIRMWARE_FILE, binary_board_config_filename=CONFIG_FILE,
+                                                   binary_user_config_filename=CONFIG_FILE,
                                                    combined_filename=tmp_file,
                                                    backup=True)
     # size of the file should be 2x the padded firmware + 2x the board config space + 2x the user config space
@@ -181,11 +151,13 @@ def test_padding_firmware(firmware_binary):
     """Test that firmware is padded to the expected size."""
     padded = builder.pad_binary_up_to_user_config(firmware_binary)
     assert len(padded) == 2080768
+    assert padded[:len(firmware_binary)] == firmware_binary
+    assert padded[len(firmware_binary):] == bytes(2080768 - len(firmware_binary))
 
 
 def test_padding_firmware_can_truncate():
     """Test that firmware is padded to the expected size."""
-    padded = builder.pad_binary_up_to_user_config(bytearray(b'\x00' * 4 * 1024 * 1024), or_truncate=True)
+    padded = builder.pad_binary_up_to_user_config(bytearray(4 * 1024 * 1024), or_truncate=True)
     assert len(padded) == 2080768
 
 
@@ -215,7 +187,7 @@ def test_firmware_plus_user_config_binary(firmware_binary, config_binary):
 
 def test_chunky_firmware_plus_user_config_binary(config_binary):
     """Test that combining giant firmware and storage produces a valid combined binary."""
-    whole_board = builder.combine_firmware_and_config(bytearray(b'\x00' * 4 * 1024 * 1024), None, config_binary,
+    whole_board = builder.combine_firmware_and_config(bytearray(4 * 1024 * 1024), None, config_binary,
                                                       replace_extra=True)
     # if this is valid, we should be able to find the storage and footer again
     storage = get_user_storage_section(whole_board)
@@ -252,20 +224,14 @@ def test_combine_must_get_at_least_one_config(firmware_binary):
         builder.combine_firmware_and_config(firmware_binary, None, None)
 
 
-def test_replace_config_in_binary(config_binary):
-    """Test that a config binary is placed in the storage location of a source binary to overwrite."""
-    whole_board = builder.replace_config_in_binary(bytearray(b'\x00' * 3 * 1024 * 1024), config_binary)
-    assert len(whole_board) == 3 * 1024 * 1024
-    # if this is valid, we should be able to find the storage and footer again
-    storage = get_user_storage_section(whole_board)
-    footer_size, _, _ = get_config_footer(storage)
-    assert footer_size == 3309
-
-
-def test_replace_config_in_binary_not_big_enough(config_binary):
-    """Test that a config binary is placed in the storage location of a source binary to pad."""
-    whole_board = builder.replace_config_in_binary(bytearray(b'\x00' * 1 * 1024 * 1024), config_binary)
-    assert len(whole_board) == 2 * 1024 * 1024
+@pytest.mark.parametrize('source_size, expected_size', [
+    (3 * 1024 * 1024, 3 * 1024 * 1024),  # big enough, so the storage location is overwritten
+    (1 * 1024 * 1024, 2 * 1024 * 1024),  # not big enough, so the binary is padded out first
+])
+def test_replace_config_in_binary(config_binary, source_size, expected_size):
+    """Test that a config binary is placed in the storage location of a source binary."""
+    whole_board = builder.replace_config_in_binary(bytearray(source_size), config_binary)
+    assert len(whole_board) == expected_size
     # if this is valid, we should be able to find the storage and footer again
     storage = get_user_storage_section(whole_board)
     footer_size, _, _ = get_config_footer(storage)
@@ -275,20 +241,16 @@ def test_replace_config_in_binary_not_big_enough(config_binary):
 def test_padding_firmware_too_big(firmware_binary):
     """Test that firmware is padded to the expected size."""
     with pytest.raises(builder.FirmwareLengthError):
-        _ = builder.pad_binary_up_to_user_config(firmware_binary + firmware_binary + firmware_binary)
+        _ = builder.pad_binary_up_to_user_config(firmware_binary * 3)
 
 
-@with_pb2s
 def test_write_new_config_to_whole_board(whole_board_dump, tmp_path):
     """Test that the config can be overwritten on a whole board dump."""
     tmp_file = os.path.join(tmp_path, 'whole-board-dump-copy.bin')
     with open(tmp_file, 'wb') as file:
         file.write(whole_board_dump)
-    # reread just in case
-    with open(tmp_file, 'rb') as file:
-        board_dump = file.read()
 
-    config = get_config(get_user_storage_section(board_dump))
+    config = get_config(get_user_storage_section(whole_board_dump))
     assert config.boardVersion == 'v0.7.5'
     config.boardVersion = 'v0.7.5-COOL'
     builder.write_new_config_to_filename(config, tmp_file, inject=True)
@@ -298,10 +260,9 @@ def test_write_new_config_to_whole_board(whole_board_dump, tmp_path):
         new_board_dump = file.read()
     config = get_config(get_user_storage_section(new_board_dump))
     assert config.boardVersion == 'v0.7.5-COOL'
-    assert len(board_dump) == len(new_board_dump)
+    assert len(whole_board_dump) == len(new_board_dump)
 
 
-@with_pb2s
 def test_write_new_config_to_firmware(firmware_binary, tmp_path):
     """Test that the config can be added on a firmware."""
     tmp_file = os.path.join(tmp_path, 'firmware-copy.bin')
@@ -321,7 +282,6 @@ def test_write_new_config_to_firmware(firmware_binary, tmp_path):
     assert len(new_board_dump) == 2 * 1024 * 1024
 
 
-@with_pb2s
 def test_write_new_config_to_config_bin(firmware_binary, tmp_path):
     """Test that the config can be written to a file."""
     tmp_file = os.path.join(tmp_path, 'config.bin')
@@ -339,7 +299,6 @@ def test_write_new_config_to_config_bin(firmware_binary, tmp_path):
     assert len(config_dump) == config_size + 12
 
 
-@with_pb2s
 def test_write_new_config_to_config_uf2(firmware_binary, tmp_path):
     """Test that the config can be written to a file."""
     tmp_file = os.path.join(tmp_path, 'config.uf2')
@@ -356,7 +315,6 @@ def test_write_new_config_to_config_uf2(firmware_binary, tmp_path):
     assert len(config_dump) == STORAGE_SIZE * 2
 
 
-@with_pb2s
 def test_write_new_config_to_config_json(config_binary, tmp_path):
     """Test that the config can be written to a file."""
     tmp_file = os.path.join(tmp_path, 'config.json')
@@ -371,30 +329,27 @@ def test_write_new_config_to_config_json(config_binary, tmp_path):
     assert config.boardVersion == 'v0.7.5'
 
 
-@with_pb2s
 def test_write_new_config_to_usb(config_binary):
     """Test that the config can be written to USB at the proper alignment."""
     config = get_config(config_binary)
-    serialized = serialize_config_with_footer(config)
-    end_out, end_in = mock.MagicMock(), mock.MagicMock()
+    end_out, end_in = SimpleNamespace(), SimpleNamespace()
     with mock.patch('gp2040ce_bintools.builder.write') as mock_write:
         builder.write_new_config_to_usb(config, end_out, end_in)
 
-    # check that it got padded
-    assert len(serialized) == 3321
-    padded_serialized = bytearray(b'\x00' * 775) + serialized
+    # check that it got padded, and that the written config round-trips
+    written = mock_write.call_args.args[3]
     assert mock_write.call_args.args[2] % 4096 == 0
-    assert mock_write.call_args.args[3] == padded_serialized
+    assert len(written) == 4096
+    assert written[:775] == bytes(775)
+    config_size, _, _ = get_config_footer(written)
+    assert config_size == 3309
+    assert get_config(written).boardVersion == config.boardVersion
 
 
 def test_get_gp2040ce_from_usb():
     """Test we attempt to read from the proper location over USB."""
-    mock_out = mock.MagicMock()
-    mock_out.device.idVendor = 0xbeef
-    mock_out.device.idProduct = 0xcafe
-    mock_out.device.bus = 1
-    mock_out.device.address = 2
-    mock_in = mock.MagicMock()
+    mock_out = SimpleNamespace(device=SimpleNamespace(idVendor=0xbeef, idProduct=0xcafe, bus=1, address=2))
+    mock_in = SimpleNamespace()
     with mock.patch('gp2040ce_bintools.builder.get_bootsel_endpoints', return_value=(mock_out, mock_in)) as mock_get:
         with mock.patch('gp2040ce_bintools.builder.read') as mock_read:
             config, _, _ = builder.get_gp2040ce_from_usb()
@@ -4,97 +4,104 @@ SPDX-FileCopyrightText: © 2023 Brian S. Stephan <bss@incorporeal.org>
 SPDX-License-Identifier: GPL-3.0-or-later
 """
 import json
+import mmap
 import os
+import shutil
 import sys
 from subprocess import run
 
-from decorator import decorator
+import pytest
 
 from gp2040ce_bintools import __version__
+from gp2040ce_bintools.builder import concatenate, summarize_gp2040ce
+from gp2040ce_bintools.storage import visualize
 
 HERE = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE_FILE = os.path.join(HERE, 'test-files', 'test-firmware.bin')
+STORAGE_FILE = os.path.join(HERE, 'test-files', 'test-storage-area.bin')
+CONFIG_JSON_FILE = os.path.join(HERE, 'test-files', 'test-config.json')
+JSON_SOURCE_CONFIG_FILE = os.path.join(HERE, 'test-files', 'test-binary-source-of-json-config.bin')
+PROTO_PATH = os.path.join(HERE, 'test-files', 'proto-files')
 
-
-@decorator
-def with_pb2s(test, *args, **kwargs):
-    """Wrap a test with precompiled pb2 files on the path."""
-    proto_path = os.path.join(HERE, 'test-files', 'pb2-files')
-    sys.path.append(proto_path)
-
-    test(*args, **kwargs)
-
-    sys.path.pop()
-    del sys.modules['config_pb2']
-    del sys.modules['enums_pb2']
-    del sys.modules['nanopb_pb2']
+# the installed entry points, for the tests that have to run the tool in a fresh interpreter
+CONCATENATE = shutil.which('concatenate')
+VISUALIZE_CONFIG = shutil.which('visualize-config')
 
 
 def test_version_flag():
-    """Test that tools report the version."""
-    result = run(['visualize-config', '-v'], capture_output=True, encoding='utf8')
-    assert f'gp2040ce-binary-tools {__version__}' in result.stdout
-    assert 'Python 3' in result.stdout
+    """Test that tools report the version (and that the installed entry point works)."""
+    result = run([VISUALIZE_CONFIG, '-v'], capture_output=True)
+    assert f'gp2040ce-binary-tools {__version__}'.encode() in result.stdout
+    assert b'Python 3' in result.stdout
 
 
-def test_help_flag():
+def test_help_flag(monkeypatch, capsys):
     """Test that tools report the usage information."""
-    result = run(['visualize-config', '-h'], capture_output=True, encoding='utf8')
-    assert 'usage: visualize-config' in result.stdout
-    assert 'Read the configuration section from a dump of a GP2040-CE board' in result.stdout
+    monkeypatch.setattr(sys, 'argv', ['visualize-config', '-h'])
+    with pytest.raises(SystemExit):
+        visualize()
+    result = capsys.readouterr()
+    assert 'usage: visualize-config' in result.out
+    assert 'Read the configuration section from a dump of a GP2040-CE board' in result.out
 
 
-def test_concatenate_invocation(tmpdir):
+def test_concatenate_invocation(tmpdir, monkeypatch, storage_dump):
     """Test that a normal invocation against a dump works."""
     out_filename = os.path.join(tmpdir, 'out.bin')
-    _ = run(['concatenate', 'tests/test-files/test-firmware.bin', '--binary-user-config-filename',
-             'tests/test-files/test-storage-area.bin', '--new-filename', out_filename])
-    with open(out_filename, 'rb') as out_file, open('tests/test-files/test-storage-area.bin', 'rb') as storage_file:
-        out = out_file.read()
-        storage = storage_file.read()
-    assert out[2080768:2097152] == storage
+    monkeypatch.setattr(sys, 'argv', ['concatenate', FIRMWARE_FILE,
+                                      '--binary-user-config-filename', STORAGE_FILE,
+                                      '--new-filename', out_filename])
+    concatenate()
+    with open(out_filename, 'rb') as out_file, mmap.mmap(out_file.fileno(), 0, access=mmap.ACCESS_READ) as out:
+        assert out[2080768:2097152] == storage_dump
 
 
 def test_concatenate_invocation_json(tmpdir):
-    """Test that a normal invocation with a firmware and a JSON file works."""
+    """Test that a normal invocation with a firmware and a JSON file works.
+
+    This runs the installed tool, since -P is handled when the package is first imported.
+    """
     out_filename = os.path.join(tmpdir, 'out.bin')
-    _ = run(['concatenate', '-P', 'tests/test-files/proto-files', 'tests/test-files/test-firmware.bin',
-             '--json-user-config-filename', 'tests/test-files/test-config.json', '--new-filename',
+    _ = run([CONCATENATE, '-P', PROTO_PATH, FIRMWARE_FILE,
+             '--json-user-config-filename', CONFIG_JSON_FILE, '--new-filename',
              out_filename])
-    with open(out_filename, 'rb') as out_file, open('tests/test-files/test-binary-source-of-json-config.bin',
+    with open(out_filename, 'rb') as out_file, open(JSON_SOURCE_CONFIG_FILE,
                                                     'rb') as storage_file:
         out = out_file.read()
         storage = storage_file.read()
-    assert out[2093382:2097152] == storage
+    assert memoryview(out)[2093382:2097152] == storage
 
 
-def test_summarize_invocation(tmpdir):
+def test_summarize_invocation(monkeypatch, capsys):
     """Test that we can get some summary information."""
-    result = run(['summarize-gp2040ce', '--filename', 'tests/test-files/test-firmware.bin'],
-                 capture_output=True, encoding='utf8')
-    assert 'detected GP2040-CE version:     v0.7.5' in result.stdout
+    monkeypatch.setattr(sys, 'argv', ['summarize-gp2040ce', '--filename', FIRMWARE_FILE])
+    summarize_gp2040ce()
+    assert 'detected GP2040-CE version:     v0.7.5' in capsys.readouterr().out
 
 
-def test_storage_dump_invocation():
+def test_storage_dump_invocation(monkeypatch, capsys):
     """Test that a normal invocation against a dump works."""
-    result = run(['visualize-config', '-P', 'tests/test-files/proto-files',
-                  '--filename', 'tests/test-files/test-storage-area.bin'],
-                 capture_output=True, encoding='utf8')
-    assert 'boardVersion: "v0.7.5"' in result.stdout
+    monkeypatch.setattr(sys, 'argv', ['visualize-config', '--filename', STORAGE_FILE])
+    visualize()
+    assert 'boardVersion: "v0.7.5"' in capsys.readouterr().out
 
 
 def test_debug_storage_dump_invocation():
-    """Test that a normal invocation against a dump works."""
-    result = run(['visualize-config', '-d', '-P', 'tests/test-files/proto-files',
-                  '--filename', 'tests/test-files/test-storage-area.bin'],
-                 capture_output=True, encoding='utf8')
-    assert 'boardVersion: "v0.7.5"' in result.stdout
-    assert 'length of content to look for footer in: 16384' in result.stderr
+    """Test that a normal invocation against a dump works.
+
+    This runs the installed tool, since -d is handled when the package is first imported.
+    """
+    result = run([VISUALIZE_CONFIG, '-d', '-P', PROTO_PATH,
+                  '--filename', STORAGE_FILE],
+                 capture_output=True)
+    assert b'boardVersion: "v0.7.5"' in result.stdout
+    assert b'length of content to look for footer in: 16384' in result.stderr
 
 
-def test_storage_dump_json_invocation():
+def test_storage_dump_json_invocation(monkeypatch, capsys):
     """Test that a normal invocation against a dump works."""
-    result = run(['visualize-config', '-P', 'tests/test-files/proto-files', '--json',
-                  '--filename', 'tests/test-files/test-storage-area.bin'],
-                 capture_output=True, encoding='utf8')
-    to_dict = json.loads(result.stdout)
+    monkeypatch.setattr(sys, 'argv', ['visualize-config', '--json',
+                                      '--filename', STORAGE_FILE])
+    visualize()
+    to_dict = json.loads(capsys.readouterr().out)
     assert to_dict['boardVersion'] == 'v0.7.5'
@@ -5,68 +5,77 @@ SPDX-License-Identifier: GPL-3.0-or-later
 """
 import os
 import sys
+import unittest.mock as mock
 
 import pytest
-from decorator import decorator
 
 from gp2040ce_bintools import get_config_pb2
 
 HERE = os.path.dirname(os.path.abspath(__file__))
+PB2_PATH = os.path.join(HERE, 'test-files', 'pb2-files')
+PROTO_PATH = os.path.join(HERE, 'test-files', 'proto-files')
 
 
-@decorator
-def with_pb2s(test, *args, **kwargs):
-    """Wrap a test with precompiled pb2 files on the path."""
-    proto_path = os.path.join(HERE, 'test-files', 'pb2-files')
-    sys.path.append(proto_path)
+def _unload_pb2s():
+    """Drop the pb2 modules from sys.modules, if they are loaded, so the next import starts clean."""
+    for module in ('config_pb2', 'enums_pb2', 'nanopb_pb2'):
+        sys.modules.pop(module, None)
 
-    test(*args, **kwargs)
-
-    sys.path.pop()
-    del sys.modules['config_pb2']
-    del sys.modules['enums_pb2']
-    del sys.modules['nanopb_pb2']
 
+@pytest.fixture
+def without_pb2s():
+    """Run a test without the pb2 modules or path that the rest of the suite shares."""
+    _unload_pb2s()
+    sys.path.remove(PB2_PATH)
+    yield
+    sys.path.append(PB2_PATH)
 
-@decorator
-def with_protos(test, *args, **kwargs):
-    """Wrap a test with .proto files on the path."""
-    proto_path = os.path.join(HERE, 'test-files', 'proto-files')
-    sys.path.append(proto_path)
-
-    test(*args, **kwargs)
 
+@pytest.fixture
+def with_protos():
+    """Put .proto files on the path for the duration of a test."""
+    sys.path.append(PROTO_PATH)
+    yield
     sys.path.pop()
-    del sys.modules['config_pb2']
-    del sys.modules['enums_pb2']
-    del sys.modules['nanopb_pb2']
+    _unload_pb2s()
 
 
-@with_pb2s
 def test_get_config_pb2_precompiled():
     """With precompiled files on the path, test we can read and use them."""
     # get the module from the provided files
     config_pb2 = get_config_pb2()
     _ = config_pb2.Config()
+    # and that asking again hands back the cached module
+    assert get_config_pb2() is config_pb2
+
+
+def test_get_config_pb2_reloads_after_unload():
+    """Test that a cached module is not handed back once it has been removed from sys.modules."""
+    config_pb2 = get_config_pb2()
+    del sys.modules['config_pb2']
+    new_config_pb2 = get_config_pb2()
+    assert new_config_pb2 is not config_pb2
+    assert sys.modules['config_pb2'] is new_config_pb2
 
 
 def test_get_config_pb2_exception():
     """Test that we fail if no config .proto files are available."""
-    with pytest.raises(RuntimeError):
-        _ = get_config_pb2()
+    # a None entry makes the import fail without unloading the module the rest of the suite uses
+    with mock.patch.dict(sys.modules, {'config_pb2': None}):
+        with pytest.raises(RuntimeError):
+            _ = get_config_pb2()
 
 
+@pytest.mark.usefixtures('without_pb2s')
 def test_get_config_pb2_shipped_config_files():
     """Without any precompiled files or proto files on the path, test we DO NOT raise an exception."""
     # use the shipped .proto files to generate the config
     config_pb2 = get_config_pb2(with_fallback=True)
     _ = config_pb2.Config()
-    del sys.modules['config_pb2']
-    del sys.modules['enums_pb2']
-    del sys.modules['nanopb_pb2']
+    _unload_pb2s()
 
 
-@with_protos
+@pytest.mark.usefixtures('without_pb2s', 'with_protos')
 def test_get_config_pb2_compile():
     """Without any precompiled files on the path, test we can read proto files and compile them."""
     # let grpc tools compile the proto files on demand and give us the module
@@ -5,30 +5,17 @@ SPDX-License-Identifier: GPL-3.0-or-later
 """
 import math
 import os
-import sys
-import unittest.mock as mock
+import threading
+from types import SimpleNamespace
 
 import pytest
-from decorator import decorator
 
 import gp2040ce_bintools.storage as storage
 from gp2040ce_bintools.builder import concatenate_firmware_and_storage_files
 
 HERE = os.path.dirname(os.path.abspath(__file__))
-
-
-@decorator
-def with_pb2s(test, *args, **kwargs):
-    """Wrap a test with precompiled pb2 files on the path."""
-    proto_path = os.path.join(HERE, 'test-files', 'pb2-files')
-    sys.path.append(proto_path)
-
-    test(*args, **kwargs)
-
-    sys.path.pop()
-    del sys.modules['config_pb2']
-    del sys.modules['enums_pb2']
-    del sys.modules['nanopb_pb2']
+FIRMWARE_FILE = os.path.join(HERE, 'test-files', 'test-firmware.bin')
+CONFIG_FILE = os.path.join(HERE, 'test-files', 'test-config.bin')
 
 
 def test_config_footer(storage_dump):
@@ -39,6 +26,14 @@ def test_config_footer(storage_dump):
     assert magic == '0x65e3f1d2'
 
 
+def test_config_footer_logs_crc_content(storage_dump, caplog):
+    """Test that the debug log shows the bytes the CRC was calculated over, not a view's address."""
+    with caplog.at_level('DEBUG', logger='gp2040ce_bintools.storage'):
+        _, _, _ = storage.get_config_footer(storage_dump)
+    assert "content used to calculate CRC: b'" in caplog.text
+    assert '<memory at' not in caplog.text
+
+
 def test_config_footer_way_too_small(storage_dump):
     """Test that a config footer isn't detected if the size is way too small."""
     with pytest.raises(storage.ConfigLengthError):
@@ -57,9 +52,20 @@ def test_whole_board_too_small(whole_board_dump):
         _, _, _ = storage.get_user_storage_section(whole_board_dump[-100000:])
 
 
+def test_storage_section_is_a_copy(whole_board_dump):
+    """Test that a storage section comes back as bytes that don't hold on to the dump it came from."""
+    board = bytearray(whole_board_dump)
+    section = storage.get_user_storage_section(board)
+    assert isinstance(section, bytes)
+    # resizing would raise BufferError if the section were still a view of the dump
+    board.clear()
+    assert len(section) == storage.STORAGE_SIZE
+
+
 def test_config_footer_bad_magic(storage_dump):
     """Test that a config footer isn't detected if the magic is incorrect."""
-    unmagical = bytearray(storage_dump)
+    # only the footer itself is needed to trip the magic check
+    unmagical = bytearray(storage_dump[-storage.FOOTER_SIZE:])
     unmagical[-1] = 0
     with pytest.raises(storage.ConfigMagicError):
         _, _, _ = storage.get_config_footer(unmagical)
@@ -67,13 +73,21 @@ def test_config_footer_bad_magic(storage_dump):
 
 def test_config_footer_bad_crc(storage_dump):
     """Test that a config footer isn't detected if the CRC checksums don't match."""
-    corrupt = bytearray(storage_dump)
-    corrupt[-50:-40] = bytearray(0 * 10)
+    # copy just the config and footer, which is all the CRC covers
+    corrupt = bytearray(storage_dump[-(3309 + storage.FOOTER_SIZE):])
+    corrupt[-50:-40] = bytes(10)
     with pytest.raises(storage.ConfigCrcError):
         _, _, _ = storage.get_config_footer(corrupt)
 
 
-@with_pb2s
+def test_config_footer_bad_crc_unverified(storage_dump):
+    """Test that a config footer is still detected with mismatched CRC checksums if told not to verify them."""
+    corrupt = bytearray(storage_dump[-(3309 + storage.FOOTER_SIZE):])
+    corrupt[-50:-40] = bytes(10)
+    size, crc, _ = storage.get_config_footer(corrupt, verify_crc=False)
+    assert (size, crc) == storage.get_config_footer(storage_dump)[:2]
+
+
 def test_get_config_from_file_storage_dump():
     """Test that we can open a storage dump file and find its config."""
     filename = os.path.join(HERE, 'test-files', 'test-storage-area.bin')
@@ -83,7 +97,6 @@ def test_get_config_from_file_storage_dump():
     assert config.addonOptions.ps4Options.enabled is False
 
 
-@with_pb2s
 def test_get_config_from_file_whole_board_dump():
     """Test that we can open a storage dump file and find its config."""
     filename = os.path.join(HERE, 'test-files', 'test-whole-board.bin')
@@ -92,7 +105,6 @@ def test_get_config_from_file_whole_board_dump():
     assert config.addonOptions.bootselButtonOptions.enabled is False
 
 
-@with_pb2s
 def test_get_board_config_from_file_whole_board_dump():
     """Test that we can open a storage dump file and find its config."""
     filename = os.path.join(HERE, 'test-files', 'test-whole-board-with-board-config.bin')
@@ -101,7 +113,47 @@ def test_get_board_config_from_file_whole_board_dump():
     assert config.addonOptions.bootselButtonOptions.enabled is False
 
 
-@with_pb2s
+def test_get_config_from_file_whole_board_uf2(tmp_path, whole_board_with_board_config_dump):
+    """Test that we can find the config in a whole board dump in UF2 format."""
+    filename = os.path.join(tmp_path, 'whole-board.uf2')
+    with open(filename, 'wb') as file:
+        file.write(storage.convert_binary_to_uf2([(0, whole_board_with_board_config_dump)]))
+    config = storage.get_config_from_file(filename, whole_board=True, board_config=True)
+    assert config.boardVersion == 'v0.7.6-15-g71f4512'
+
+
+def test_get_config_from_file_whole_board_empty(tmp_path):
+    """Test that an empty file is reported as not having a storage section."""
+    filename = os.path.join(tmp_path, 'empty.bin')
+    open(filename, 'wb').close()
+    with pytest.raises(storage.ConfigLengthError):
+        _ = storage.get_config_from_file(filename, whole_board=True)
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/fd'), reason="needs /dev/fd to name the pipe")
+def test_get_config_from_file_whole_board_pipe(whole_board_dump):
+    """Test that a whole board dump can be read from a pipe, which can't be memory mapped."""
+    read_fd, write_fd = os.pipe()
+
+    def feed():
+        with os.fdopen(write_fd, 'wb') as pipe_in:
+            try:
+                pipe_in.write(whole_board_dump)
+            except BrokenPipeError:
+                pass  # the reader gave up early, which the test reports on its own
+
+    # the dump is bigger than the pipe's buffer, so feed it while it is being read
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    try:
+        config = storage.get_config_from_file(f'/dev/fd/{read_fd}', whole_board=True)
+    finally:
+        # close the read end first, so the feeder can't block forever on a reader that stopped
+        os.close(read_fd)
+        feeder.join()
+    assert config.boardVersion == 'v0.7.5'
+
+
 def test_get_board_config_from_json_file():
     """Test that we can open a JSON file and parse the config."""
     filename = os.path.join(HERE, 'test-files', 'test-config.json')
@@ -110,7 +162,6 @@ def test_get_board_config_from_json_file():
     assert config.addonOptions.bootselButtonOptions.enabled is False
 
 
-@with_pb2s
 def test_get_config_from_file_file_not_fonud_ok():
     """If we allow opening a file that doesn't exist (e.g. for the editor), check we get an empty config."""
     filename = os.path.join(HERE, 'test-files', 'nope.bin')
@@ -125,7 +176,6 @@ def test_get_config_from_file_file_not_fonud_raise():
         _ = storage.get_config_from_file(filename)
 
 
-@with_pb2s
 def test_config_parses(storage_dump):
     """Test that we need the config_pb2 to exist/be compiled for reading the config to work."""
     config = storage.get_config(storage_dump)
@@ -134,7 +184,6 @@ def test_config_parses(storage_dump):
     assert config.hotkeyOptions.hotkey02.dpadMask == 1
 
 
-@with_pb2s
 def test_config_from_whole_board_parses(whole_board_dump):
     """Test that we can read in a whole board and still find the config section."""
     config = storage.get_config(storage.get_user_storage_section(whole_board_dump))
@@ -198,14 +247,16 @@ def test_malformed_uf2(whole_board_with_board_config_dump):
     with pytest.raises(ValueError):
         storage.convert_uf2_to_binary(uf2 + uf2)
 
+    # empty UF2 --- no blocks at all
+    with pytest.raises(ValueError):
+        storage.convert_uf2_to_binary(bytearray())
+
 
 def test_read_created_uf2(tmp_path, firmware_binary, config_binary):
     """Test that we read a UF2 with disjoint segments."""
     tmp_file = os.path.join(tmp_path, 'concat.uf2')
-    firmware_file = os.path.join(HERE, 'test-files', 'test-firmware.bin')
-    config_file = os.path.join(HERE, 'test-files', 'test-config.bin')
-    concatenate_firmware_and_storage_files(firmware_file, binary_board_config_filename=config_file,
-                                           binary_user_config_filename=config_file,
+    concatenate_firmware_and_storage_files(FIRMWARE_FILE, binary_board_config_filename=CONFIG_FILE,
+                                           binary_user_config_filename=CONFIG_FILE,
                                            combined_filename=tmp_file)
     with open(tmp_file, 'rb') as file:
         content = file.read()
@@ -222,6 +273,15 @@ def test_read_created_uf2(tmp_path, firmware_binary, config_binary):
     assert footer_size == 3309
 
 
+def test_get_binary_from_file_detects_uf2_without_suffix(tmp_path, whole_board_dump):
+    """Test that a UF2 file is converted back to a binary even if it isn't named .uf2."""
+    tmp_file = os.path.join(tmp_path, 'misnamed.bin')
+    with open(tmp_file, 'wb') as file:
+        file.write(storage.convert_binary_to_uf2([(0, whole_board_dump)]))
+
+    assert storage.get_binary_from_file(tmp_file) == whole_board_dump
+
+
 def test_cant_read_out_of_order_uf2():
     """Test that we currently raise an exception at out of order UF2s until we fix it."""
     uf2 = storage.convert_binary_to_uf2([(0x1000, b'\x11'), (0, b'\x11')])
@@ -229,7 +289,6 @@ def test_cant_read_out_of_order_uf2():
         storage.convert_uf2_to_binary(uf2)
 
 
-@with_pb2s
 def test_serialize_config_with_footer(storage_dump, config_binary):
     """Test that reserializing a read in config matches the original.
 
@@ -243,7 +302,6 @@ def test_serialize_config_with_footer(storage_dump, config_binary):
     assert storage_dump[-4:] == reserialized[-4:]
 
 
-@with_pb2s
 def test_serialize_modified_config_with_footer(storage_dump):
     """Test that we can serialize a modified config."""
     config = storage.get_config(storage_dump)
@@ -266,43 +324,63 @@ def test_pad_config_to_storage_raises(config_binary):
         _ = storage.pad_config_to_storage_size(config_binary * 5)
 
 
-@with_pb2s
-def test_get_board_config_from_usb(config_binary):
+def test_serialize_padded_config(storage_dump):
+    """Test that serializing straight to a storage section matches padding the serialized config."""
+    config = storage.get_config(storage_dump)
+    storage_section = storage.serialize_padded_config(config)
+    assert len(storage_section) == 16384
+    assert storage_section == storage.pad_config_to_storage_size(storage.serialize_config_with_footer(config))
+
+
+def test_serialize_padded_config_raises(storage_dump):
+    """Test that we raise an exception if the config is bigger than the storage section."""
+    config = storage.get_config(storage_dump)
+    config.boardVersion = 'v' * 16384
+    with pytest.raises(storage.ConfigLengthError):
+        _ = storage.serialize_padded_config(config)
+
+
+@pytest.fixture
+def fake_usb(monkeypatch, config_binary):
+    """Stand in for a board in BOOTSEL mode, serving the test config and recording the reads made of it."""
+    device = SimpleNamespace(idVendor=0xbeef, idProduct=0xcafe, bus=1, address=2)
+    usb = SimpleNamespace(out_end=SimpleNamespace(device=device), in_end=SimpleNamespace(), reads=[])
+
+    def fake_read(*args):
+        usb.reads.append(args)
+        return config_binary
+
+    monkeypatch.setattr('gp2040ce_bintools.storage.get_bootsel_endpoints', lambda: (usb.out_end, usb.in_end))
+    monkeypatch.setattr('gp2040ce_bintools.storage.read', fake_read)
+    return usb
+
+
+def test_get_board_config_from_usb(fake_usb, config_binary):
     """Test we attempt to read from the proper location over USB."""
-    mock_out = mock.MagicMock()
-    mock_out.device.idVendor = 0xbeef
-    mock_out.device.idProduct = 0xcafe
-    mock_out.device.bus = 1
-    mock_out.device.address = 2
-    mock_in = mock.MagicMock()
-    with mock.patch('gp2040ce_bintools.storage.get_bootsel_endpoints', return_value=(mock_out, mock_in)) as mock_get:
-        with mock.patch('gp2040ce_bintools.storage.read', return_value=config_binary) as mock_read:
-            config, _, _ = storage.get_board_config_from_usb()
-
-    mock_get.assert_called_once()
-    mock_read.assert_called_with(mock_out, mock_in, 0x101F8000, 16384)
+    config, _, _ = storage.get_board_config_from_usb()
+
+    assert fake_usb.reads == [(fake_usb.out_end, fake_usb.in_end, 0x101F8000, 16384)]
     assert config == storage.get_config(config_binary)
 
 
-@with_pb2s
-def test_get_user_config_from_usb(config_binary):
+def test_get_user_config_from_usb(fake_usb, config_binary):
     """Test we attempt to read from the proper location over USB."""
-    mock_out = mock.MagicMock()
-    mock_out.device.idVendor = 0xbeef
-    mock_out.device.idProduct = 0xcafe
-    mock_out.device.bus = 1
-    mock_out.device.address = 2
-    mock_in = mock.MagicMock()
-    with mock.patch('gp2040ce_bintools.storage.get_bootsel_endpoints', return_value=(mock_out, mock_in)) as mock_get:
-        with mock.patch('gp2040ce_bintools.storage.read', return_value=config_binary) as mock_read:
-            config, _, _ = storage.get_user_config_from_usb()
-
-    mock_get.assert_called_once()
-    mock_read.assert_called_with(mock_out, mock_in, 0x101FC000, 16384)
+    config, _, _ = storage.get_user_config_from_usb()
+
+    assert fake_usb.reads == [(fake_usb.out_end, fake_usb.in_end, 0x101FC000, 16384)]
     assert config == storage.get_config(config_binary)
 
 
-@with_pb2s
+def test_visualize_usb_verifies_crc(fake_usb, monkeypatch, config_binary):
+    """Test that a config read off a board still has its CRC checked before it is displayed."""
+    corrupt = bytearray(config_binary)
+    corrupt[-50:-40] = bytes(10)
+    monkeypatch.setattr('gp2040ce_bintools.storage.read', lambda *args: corrupt)
+    monkeypatch.setattr('sys.argv', ['visualize-config', '--usb'])
+    with pytest.raises(storage.ConfigCrcError):
+        storage.visualize()
+
+
 def test_json_config_parses(config_json):
     """Test that we can import a JSON config into a message."""
     config = storage.get_config_from_json(config_json)